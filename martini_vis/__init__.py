@@ -32,4 +32,6 @@ else:
 from .src.system_reading import system_reading
 from .src.index_writer import index_writing
 from .src.molecule_editing import molecule_editor
-from .src.topology import topol_writing
+from .src.level_of_detail import lod_profile
+from .src.topology import topol_writing, shard_writing
+from .src.bond_strain import strain_analysis, strain_writing
@@ -0,0 +1,317 @@
+# Copyright 2020 University of Groningen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ProcessPoolExecutor
+from os.path import isfile
+from vermouth.gmx import read_itp
+from vermouth.forcefield import ForceField
+import numpy as np
+from .system_reading import system_reading
+from .topology import molecule_atom_count
+
+
+def _surplus_en_bonds(molname):
+    """
+    Read the elastic network bonds which en_writer left out of {molname}_en.itp for VMD
+
+    Returns
+    -------
+    bonds: list
+        [atom, atom] pairs of 0-based atom indices in the molecule
+    b0: list
+        bond lengths
+    """
+    bonds = []
+    b0 = []
+    if not isfile(f'{molname}_surplus_en.txt'):
+        return bonds, b0
+    with open(f'{molname}_surplus_en.txt') as f:
+        lines = f.readlines()
+    # the bonds follow the column header
+    header = [line.split() for line in lines].index(['i', 'j', 'func', 'b0', 'kb'])
+    for line in lines[header + 1:]:
+        tokens = line.split()
+        if tokens:
+            bonds.append([int(tokens[0]), int(tokens[1])])
+            b0.append(float(tokens[3]))
+    return bonds, b0
+
+
+def network_bonds(topology, network='en'):
+    """
+    Find the elastic network or Gō bonds of every molecule in the system
+
+    The bonds are read from the {molname}_en.itp or {molname}_go.itp files written
+    by en_writer and go_writer, and are offset to match atom numbering in the whole system.
+    Elastic network bonds which en_writer left out of the itps for VMD are read back in
+    from {molname}_surplus_en.txt, so every bond in the simulation is included.
+
+    Parameters
+    ----------
+    topology: str
+        the .top file of the simulated system
+    network: str
+        'en' or 'go', which type of network bonds to read
+
+    Returns
+    -------
+    bonds: dict
+        n_atoms: (n_bonds, 2) array of 0-based atom indices in the whole system, for the
+        system with water and without it (e.g. if the trajectory was written with index_writing)
+    b0: numpy.ndarray
+        (n_bonds,) array of equilibrium bond lengths from the network itps.
+        For Gō bonds this is the LJ minimum, 2^(1/6) sigma.
+    """
+    ff, topol_lines, _ = system_reading(topology)
+
+    bonds = []
+    bonds_no_water = []
+    b0 = []
+    offset = 0
+    offset_no_water = 0
+    for mol in topol_lines['molecules']:
+        molname = mol['name']
+        n_mols = int(mol['n_mols'])
+        mol_atoms = molecule_atom_count(ff, topol_lines, molname)
+        if mol_atoms is None:
+            raise ValueError(f"Can't find the atoms of {molname} in {topology}, "
+                             "so the network bonds can't be matched to the system.")
+
+        network_file = f'{molname}_{network}.itp'
+        if isfile(network_file):
+            net_ff = ForceField('martini3001')
+            with open(network_file) as f:
+                read_itp(f.readlines(), net_ff)
+            net_block = net_ff.blocks[f'{molname}_{network}']
+            mol_bonds = [list(bond.atoms) for bond in net_block.interactions['bonds']]
+            mol_b0 = [float(bond.parameters[1]) for bond in net_block.interactions['bonds']]
+            if network == 'en':
+                surplus_bonds, surplus_b0 = _surplus_en_bonds(molname)
+                mol_bonds += surplus_bonds
+                mol_b0 += surplus_b0
+            mol_bonds = np.array(mol_bonds, dtype=int)
+            mol_b0 = np.array(mol_b0)
+            if network == 'go':
+                # the Gō bonds hold the LJ sigma of each contact, which has its minimum at 2^(1/6) sigma
+                mol_b0 = mol_b0 * 2 ** (1 / 6)
+            if len(mol_bonds) > 0:
+                copies = mol_atoms * np.arange(n_mols)
+                mol_bonds = (mol_bonds[None, :, :] + copies[:, None, None]).reshape(-1, 2)
+                bonds.append(mol_bonds + offset)
+                bonds_no_water.append(mol_bonds + offset_no_water)
+                b0.append(np.tile(mol_b0, n_mols))
+
+        offset += mol_atoms * n_mols
+        if molname != 'W':
+            offset_no_water += mol_atoms * n_mols
+
+    if len(bonds) == 0:
+        raise FileNotFoundError(f"No {network} itps found for the molecules in {topology}."
+                                f" Run martini_vis with -{'el' if network == 'en' else 'go'} first.")
+
+    return ({offset: np.concatenate(bonds), offset_no_water: np.concatenate(bonds_no_water)},
+            np.concatenate(b0))
+
+
+def _box_matrix(box_line):
+    """
+    Convert the box line of a .gro frame into a matrix with the box vectors as rows
+    """
+    values = [float(i) for i in box_line.split()]
+    box = np.diag(values[:3])
+    if len(values) == 9:
+        # v1(y) v1(z) v2(x) v2(z) v3(x) v3(y)
+        box[0, 1], box[0, 2], box[1, 0], box[1, 2], box[2, 0], box[2, 1] = values[3:]
+    return box
+
+
+def gro_chunks(system, chunk_size=100):
+    """
+    Stream the frames of a multi-frame .gro file in chunks
+
+    Only one chunk of lines is held in memory at a time.
+
+    Parameters
+    ----------
+    system: str
+        the .gro file to read
+    chunk_size: int
+        maximum number of frames to return in each chunk
+
+    Yields
+    ------
+    positions: numpy.ndarray
+        (n_frames, n_atoms, 3) array of positions
+    boxes: numpy.ndarray
+        (n_frames, 3, 3) array of box vectors
+    """
+    with open(system) as f:
+        frames = []
+        boxes = []
+        while True:
+            title = f.readline()
+            if not title:
+                break
+            n_atoms = int(f.readline())
+            lines = [f.readline() for _ in range(n_atoms)]
+            frames.append([[line[20:28], line[28:36], line[36:44]] for line in lines])
+            boxes.append(_box_matrix(f.readline()))
+            if len(frames) == chunk_size:
+                yield np.array(frames, dtype=float), np.array(boxes)
+                frames = []
+                boxes = []
+        if frames:
+            yield np.array(frames, dtype=float), np.array(boxes)
+
+
+def bond_lengths(positions, boxes, bonds):
+    """
+    Calculate the lengths of all bonds in every frame using the minimum image convention
+
+    Parameters
+    ----------
+    positions: numpy.ndarray
+        (n_frames, n_atoms, 3) array of positions
+    boxes: numpy.ndarray
+        (n_frames, 3, 3) array of box vectors
+    bonds: numpy.ndarray
+        (n_bonds, 2) array of atom indices
+
+    Returns
+    -------
+    lengths: numpy.ndarray
+        (n_frames, n_bonds) array of bond lengths
+    """
+    vectors = positions[:, bonds[:, 1]] - positions[:, bonds[:, 0]]
+    # shift to fractional coordinates, wrap, and shift back.
+    # this is exact for rectangular boxes and a good approximation for triclinic ones.
+    fractional = np.einsum('fbi,fij->fbj', vectors, np.linalg.inv(boxes))
+    fractional -= np.round(fractional)
+    vectors = np.einsum('fbi,fij->fbj', fractional, boxes)
+    return np.linalg.norm(vectors, axis=-1)
+
+
+def _chunk_statistics(positions, boxes, bonds, b0, threshold):
+    """
+    Calculate the running statistics for a single chunk of frames
+    """
+    lengths = bond_lengths(positions, boxes, bonds)
+    strain = np.abs(lengths - b0) / b0
+    return (len(lengths),
+            lengths.sum(axis=0),
+            strain.max(axis=0),
+            (strain > threshold).sum(axis=0))
+
+
+def strain_analysis(topology, system, network='en', threshold=0.1, chunk_size=100, nprocs=1):
+    """
+    Calculate per-bond statistics of the elastic network or Gō bonds over a trajectory
+
+    Parameters
+    ----------
+    topology: str
+        the .top file of the simulated system
+    system: str
+        multi-frame .gro file of the system, with or without water
+    network: str
+        'en' or 'go', which type of network bonds to analyse
+    threshold: float
+        fraction of b0 above which a bond is counted as overstrained in a frame
+    chunk_size: int
+        number of frames to read and analyse at once
+    nprocs: int
+        number of processes to analyse chunks of frames with
+
+    Returns
+    -------
+    stats: dict
+        per-bond arrays of atom indices (1-based), b0, mean length, maximum strain
+        and the fraction of frames in which the strain is over the threshold
+    """
+    if system.suffix != ".gro":
+        raise TypeError('Must provide a file in .gro format')
+
+    print(f"Analysing {network} bond strain in {system}")
+    system_bonds, b0 = network_bonds(topology, network)
+    bonds = None
+
+    n_frames = 0
+    length_sum = np.zeros(len(b0))
+    max_strain = np.zeros(len(b0))
+    n_over = np.zeros(len(b0), dtype=int)
+
+    def accumulate(result):
+        nonlocal n_frames, max_strain
+        n_frames += result[0]
+        length_sum[:] += result[1]
+        max_strain = np.maximum(max_strain, result[2])
+        n_over[:] += result[3]
+
+    def checked(chunks):
+        nonlocal bonds
+        for positions, boxes in chunks:
+            try:
+                bonds = system_bonds[positions.shape[1]]
+            except KeyError:
+                raise ValueError(f'{system} has {positions.shape[1]} atoms, which matches neither '
+                                 f'{topology} with water nor without it: '
+                                 f'{" or ".join(map(str, system_bonds))}')
+            yield positions, boxes
+
+    chunks = checked(gro_chunks(system, chunk_size))
+    if nprocs > 1:
+        # keep a bounded number of chunks in flight so memory use doesn't grow with the trajectory
+        with ProcessPoolExecutor(max_workers=nprocs) as executor:
+            pending = []
+            for positions, boxes in chunks:
+                pending.append(executor.submit(_chunk_statistics, positions, boxes, bonds, b0, threshold))
+                if len(pending) >= 2 * nprocs:
+                    accumulate(pending.pop(0).result())
+            for future in pending:
+                accumulate(future.result())
+    else:
+        for positions, boxes in chunks:
+            accumulate(_chunk_statistics(positions, boxes, bonds, b0, threshold))
+
+    if n_frames == 0:
+        raise ValueError(f'No frames found in {system}')
+
+    return {'i': bonds[:, 0] + 1,
+            'j': bonds[:, 1] + 1,
+            'b0': b0,
+            'mean': length_sum / n_frames,
+            'max_strain': max_strain,
+            'frac_over': n_over / n_frames}
+
+
+def strain_writing(stats, network='en'):
+    """
+    Write per-bond strain statistics to {network}_strain.npz and {network}_strain.csv
+
+    Parameters
+    ----------
+    stats: dict
+        output of strain_analysis
+    network: str
+        'en' or 'go', used to name the output files
+
+    Returns
+    -------
+    None
+    """
+    np.savez_compressed(f'{network}_strain.npz', **stats)
+    columns = list(stats)
+    np.savetxt(f'{network}_strain.csv', np.column_stack([stats[i] for i in columns]),
+               fmt=['%d', '%d', '%.3f', '%.4f', '%.4f', '%.4f'],
+               delimiter=',', header=','.join(columns), comments='')
@@ -0,0 +1,155 @@
+# Copyright 2020 University of Groningen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from vermouth.gmx import write_molecule_itp
+import networkx as nx
+
+# options which can be given in a level of detail profile, and their values in the full detail topology
+LOD_OPTIONS = {'bb': ('backbone', True),
+               'ht': ('head_tail', True),
+               'novs': ('virtual_sites', False),
+               'nopairs': ('pairs', False),
+               'nocons': ('constraints', False)}
+
+
+def lod_profile(spec):
+    """
+    Read a level of detail profile from a comma separated string of options
+
+    Parameters
+    ----------
+    spec: str
+        options for the profile, any of:
+        bb: only keep bonds between the backbone (BB) beads of consecutive residues in molecules
+            which have them, i.e. proteins
+        ht: only keep bonds from the first bead to the furthest one from it in molecules without
+            backbone beads, e.g. from the head to the tail of a lipid
+        novs: don't keep bonds between virtual sites and their constructing atoms
+        nopairs: don't keep pairs written as bonds
+        nocons: don't keep constraints written as bonds
+        every=N: only write bonds for every Nth copy of each molecule
+
+    Returns
+    -------
+    profile: dict
+        the options of the profile
+    """
+    profile = {'backbone': False,
+               'head_tail': False,
+               'virtual_sites': True,
+               'pairs': True,
+               'constraints': True,
+               'every': 1}
+    for option in spec.split(','):
+        option = option.strip()
+        if option in LOD_OPTIONS:
+            key, value = LOD_OPTIONS[option]
+            profile[key] = value
+        elif option.startswith('every='):
+            profile['every'] = int(option.split('=')[1])
+            if profile['every'] < 1:
+                raise ValueError(f'every must be at least 1, not {profile["every"]}')
+        else:
+            raise ValueError(f'Unknown level of detail option {option}. '
+                             f'Choose from {", ".join(LOD_OPTIONS)} or every=N')
+    return profile
+
+
+def _head_tail_bonds(block, bonds):
+    """
+    Find the bonds on the shortest path from the first atom of a molecule to the atom furthest from it
+    """
+    graph = nx.Graph()
+    graph.add_nodes_from(block.nodes)
+    graph.add_edges_from(bond.atoms for bond in bonds)
+    head = list(block.nodes)[0]
+    lengths = nx.single_source_shortest_path_length(graph, head)
+    tail = max(lengths, key=lengths.get)
+    path = nx.shortest_path(graph, head, tail)
+    path_edges = {frozenset(edge) for edge in zip(path[:-1], path[1:])}
+    return [bond for bond in bonds if frozenset(bond.atoms) in path_edges]
+
+
+def lod_writer(block, molname, bond_sources, profile, level, ext):
+    """
+    write a reduced level of detail visualisation topology for a particular molecule
+
+    Parameters
+    ----------
+    block: vermouth block
+        the visualisation block of the molecule, with all its interactions rewritten as bonds
+    molname: str
+        name of the molecule
+    bond_sources: dict
+        position in the block's bonds: the interaction type that each bond was rewritten from.
+        Bonds which aren't in it were bonds in the original molecule.
+    profile: dict
+        level of detail options, as per lod_profile
+    level: int
+        number of the level of detail, used to name the output files
+    ext: bool
+        also write the bonds to a text file
+
+    Returns
+    -------
+    written: list
+        names of the itp files written
+    """
+    bonds = []
+    for index, bond in enumerate(block.interactions['bonds']):
+        source = bond_sources.get(index, 'bonds')
+        if source == 'bonds' or profile[source]:
+            bonds.append(bond)
+
+    atomnames = [block.nodes[node].get('atomname') for node in block.nodes]
+    if 'BB' in atomnames:
+        if profile['backbone']:
+            # only the bonds along the backbone, between consecutive residues.
+            # this leaves out elastic network bonds, which are also between BB beads.
+            bonds = [bond for bond in bonds
+                     if all(block.nodes[atom].get('atomname') == 'BB' for atom in bond.atoms)
+                     and abs(block.nodes[bond.atoms[0]].get('resid', 0) -
+                             block.nodes[bond.atoms[1]].get('resid', 0)) == 1]
+    elif profile['head_tail'] and len(bonds) > 1:
+        bonds = _head_tail_bonds(block, bonds)
+
+    mols_out = []
+    all_bonds = block.interactions['bonds']
+    block.interactions['bonds'] = bonds
+    mol_out = block.to_molecule()
+    mol_out.meta['moltype'] = f'{molname}_vis_lod{level}'
+    mols_out.append(mol_out)
+    # the copies which aren't drawn in detail have no bonds at all
+    if profile['every'] > 1 and bonds:
+        block.interactions['bonds'] = []
+        mol_out = block.to_molecule()
+        mol_out.meta['moltype'] = f'{molname}_vis_lod{level}_nobonds'
+        mols_out.append(mol_out)
+    block.interactions['bonds'] = all_bonds
+
+    if ext:
+
+        ext_bonds_list = [i.atoms for i in mols_out[0].interactions['bonds']]
+        stout = ''.join([f'{i[0]}\t{i[1]}\n' for i in ext_bonds_list])
+        with open(f'{molname}_lod{level}_bonds.txt', 'w') as bonds_list_out:
+            bonds_list_out.write(stout)
+
+    header = [f'Level of detail {level} visualisation topology for {molname}', 'NOT FOR SIMULATIONS']
+
+    written = []
+    for mol_out in mols_out:
+        with open(mol_out.meta['moltype'] + '.itp', 'w') as fout:
+            write_molecule_itp(mol_out, outfile=fout, header=header)
+            written.append(fout.name)
+    return written
@@ -17,12 +17,13 @@ from os.path import isfile
 from vermouth.gmx import write_molecule_itp
 from .elastic_writer import en_writer
 from .go_writer import go_writer
+from .level_of_detail import lod_writer
 
 
 def molecule_editor(ff, topol_lines, system_defines,
                     virtual_sites=True, ext=False,
                     elastic=False, elastic_force=700,
-                    go=False, go_path='', go_file=''):
+                    go=False, go_path='', go_file='', lod_profiles=()):
     # iterate over the molecules to make visualisation topologies
     keep = ['bonds', 'constraints', 'pairs', 'virtual_sitesn',
             'virtual_sites2', 'virtual_sites3']
@@ -72,6 +73,10 @@ def molecule_editor(ff, topol_lines, system_defines,
             en_written = en_writer(ff_en_copy, molname, en_bonds, ext)
             written_mols.append(en_written)
 
+        # keep track of which interactions the visualisation bonds come from for the levels of detail,
+        # by their position in the bonds. bonds which were already in the molecule aren't recorded.
+        bond_sources = {}
+
         # this should then keep any constraints which don't have IFDEF statements
         # e.g. alpha helices are described by constraints without these.
         # however, the remove_interactions function doesn't work atm.
@@ -80,11 +85,13 @@ def molecule_editor(ff, topol_lines, system_defines,
                 block.remove_interaction('constraints', bond.atoms)
             else:
                 block.add_interaction('bonds', bond.atoms, bond.parameters + ['10000'])
+                bond_sources[len(block.interactions['bonds']) - 1] = 'constraints'
                 block.remove_interaction('constraints', bond.atoms)
 
         # rewrite pairs as bonds for visualisation
         for bond in block.interactions['pairs']:
             block.add_interaction('bonds', bond.atoms, bond.parameters[:2] + ['10000'])
+            bond_sources[len(block.interactions['bonds']) - 1] = 'pairs'
         del block.interactions['pairs']
 
         # make bonds between virtual sites and each of the constructing atoms
@@ -110,6 +117,7 @@ def molecule_editor(ff, topol_lines, system_defines,
                             # completely arbitrary parameters, the bond just needs to exist
                             block.add_interaction('bonds', [site, constructor],
                                                   ['1', '1', '1000'])
+                            bond_sources[len(block.interactions['bonds']) - 1] = 'virtual_sites'
             if block.interactions[vs_type]:
                 del block.interactions[vs_type]
 
@@ -143,6 +151,10 @@ def molecule_editor(ff, topol_lines, system_defines,
             go_written = go_writer(ff_go_copy, molname, bonds_list, ext)
             written_mols.append(go_written)
 
+        # write reduced levels of detail for the molecule
+        for level, profile in enumerate(lod_profiles, start=1):
+            written_mols.extend(lod_writer(block, molname, bond_sources, profile, level, ext))
+
         # write out the molecule with an amended name
         mol_out = block.to_molecule()
         mol_out.meta['moltype'] = molname + '_vis'
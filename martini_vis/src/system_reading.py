@@ -15,6 +15,8 @@
 from vermouth.gmx import read_itp
 from vermouth.forcefield import ForceField
 from .topology import input_topol_reader
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
 import re
 
 
@@ -73,73 +75,110 @@ def secondary_structure_parsing(lines, molname):
             f.write(f'\nsheets: name BB and ({sht_col_str})')
 
 
-def _misc_file_reader(lines):
+def _detach_blocks(ff):
     """
-    Try to handle miscellaneous files which can't be read into the force field by read_itp
+    Make the blocks of a force field picklable so they can be returned from a worker process.
+
+    The reference back to the force field and the lambda-based log_entries of each
+    block can't be pickled, so they're removed here and restored by _attach_block.
+    """
+    for block in ff.blocks.values():
+        block._force_field = None
+        block.log_entries = dict(block.log_entries)
+    return ff.blocks
+
+
+def _attach_block(ff, molname, block):
+    """
+    Add a block parsed by _itp_parsing to the system force field.
+    """
+    block._force_field = ff
+    block.log_entries = defaultdict(lambda: defaultdict(list), block.log_entries)
+    ff.blocks[molname] = block
+
+
+def _itp_parsing(lines):
+    """
+    Parse the lines of a single itp into a force field of its own
+
+    This runs independently of every other itp in the system, so it can be
+    done in a separate process. The blocks are merged back into the system
+    force field by system_reading.
 
     Parameters
     ----------
     lines: list
         list of lines from the input .itp file
 
-
     Returns
     -------
-    defines: dict
-        dictionary of definition: parameters for bonded terms that have been externally defined
-    others: list
-        lines from an input itp that don't have #define in them
-
-    if others == lines, None is returned, because the input file doesn't contain anything interesting
+    blocks: dict or None
+        molname: vermouth block for each molecule read from the file.
+        None if the lines can't be read as a molecule, e.g. the force field definition file.
     """
-    defines = {i.split()[1]: i.split(';')[0].split()[2:5] for i in lines if '#define' in i}
-    others = [line for line in lines if '#define' not in line]
-    if others == lines:
+    ff = ForceField('martini3001')
+    try:
+        read_itp(lines, ff)
+    except OSError:
+        # most likely its the force field definition file (eg. martini_v3.0.0.itp)
         return None
-    else:
-        return defines, others
+    return _detach_blocks(ff)
 
 
-def system_reading(topology):
+def system_reading(topology, nprocs=1, defines=('FLEXIBLE',)):
 
     """
     read a .top file's contents into a ForceField
+
+    Parameters
+    ----------
+    topology: str
+        path to the input .top file
+    nprocs: int
+        number of processes to use for parsing the itps in the system.
+    defines: iterable
+        symbols to define when preprocessing the topology, as per input_topol_reader
+
+    Returns
+    -------
+    ff: vermouth forcefield
+        force field containing the blocks of all the molecules in the system, in include order
+    topol_lines: dict
+        lines from the input topology file, as per input_topol_reader
+    system_defines: dict
+        #define statements found in the topology, later files taking precedence
     """
 
     # get the topology file
     print(f"Reading input {topology}")
-    topol_lines = input_topol_reader(topology)
+    topol_lines = input_topol_reader(topology, defines)
+
+    # for each molecule in the system, the preprocessed itp lines
+    d = topol_lines['itp_lines']
 
-    # for each molecule in the system, read in the itp
-    d = {}
-    for i, j in enumerate(topol_lines['core_itps']):
-        with open(j) as f:
-            d[i] = f.readlines()
+    # parse the itps independently of each other
+    if nprocs > 1 and len(d) > 1:
+        with ProcessPoolExecutor(max_workers=nprocs) as executor:
+            parsed = list(executor.map(_itp_parsing, d))
+    else:
+        parsed = [_itp_parsing(lines) for lines in d]
 
-    # read the molecules into the forcefield
+    # read the molecules into the forcefield, in the order they were included
     ff = ForceField('martini3001')
 
-    system_defines = {}
-    for i, j in enumerate(d.keys()):
-        try:
-            read_itp(d[j], ff)
-            secondary_structure_parsing(d[j], list(ff.blocks)[-1])
-        except OSError:
-            '''
-            if we can't read the file into the system directly, we have something that isn't strictly a molecule
-            most likely its the force field definition file (eg. martini_v3.0.0.itp) but we can't be sure
-            a common one is something with #defines in for generic molecule bonded terms
-            '''
-            misc_result = _misc_file_reader(d[j])
-            if misc_result is None:
-                # if [ defaults ] is found, then it's martini_v3.0.0.itp or similar. ignore it.
-                if "[ defaults ]" not in [k.strip() for k in d[j]]:
-                    print(f"Error reading {topol_lines['core_itps'][i]}. Will ignore and exclude from output system.")
-            else:
-                # this means we've separated things out successfully and can read the actual itp content now
-                # tracking system_defines is useful for when we sort the #TODOs below.
-                for key, value in misc_result[0].items():
-                    system_defines[key] = value
-                read_itp(misc_result[1], ff)
+    # #define statements for bonded terms are collected while preprocessing the topology
+    system_defines = dict(topol_lines['defines'])
+    for path, lines, blocks in zip(topol_lines['core_itps'], d, parsed):
+        if blocks is None:
+            # if [ defaults ] is found, then it's martini_v3.0.0.itp or similar. ignore it.
+            if "[ defaults ]" not in [k.strip() for k in lines]:
+                print(f"Error reading {path}. Will ignore and exclude from output system.")
+            continue
+
+        for molname, block in blocks.items():
+            _attach_block(ff, molname, block)
+
+        if blocks:
+            secondary_structure_parsing(lines, list(ff.blocks)[-1])
 
     return ff, topol_lines, system_defines
@@ -12,38 +12,256 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+SECTION = re.compile(r'^\s*\[\s*(\w+)\s*\]')
+INCLUDE = re.compile(r'^\s*#include\s+["<](.+?)[">]')
+
+# sections which describe the force field rather than a molecule.
+# an #include found in one of these starts a new unit rather than being read as part of a molecule.
+FF_SECTIONS = {'defaults', 'atomtypes', 'bondtypes', 'constrainttypes', 'pairtypes', 'angletypes',
+               'dihedraltypes', 'nonbond_params', 'cmaptypes'}
+
+
+def _read_lines(path):
+    with open(path) as f:
+        return f.readlines()
+
+
+def _include_path(name, parent):
+    """
+    Find an #include'd file the same way as grompp: relative to the including file,
+    then the current directory, then the directories in GMXLIB.
+
+    Returns None if the file can't be found.
+    """
+    search = [os.path.dirname(parent), os.getcwd()]
+    search += [i for i in os.environ.get('GMXLIB', '').split(os.pathsep) if i]
+    for directory in search:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return os.path.abspath(path)
+    return None
+
+
+def _read_include_graph(file):
+    """
+    Read every file that can be reached by #include from the input file, exactly once
+
+    Conditionals are ignored here, so that everything which might be needed is read in.
+    Each level of the include graph is read with a pool of threads.
+
+    Parameters
+    ----------
+    file: str
+        the .top file to start from
+
+    Returns
+    -------
+    memo: dict
+        absolute path: lines for each file in the include graph
+    """
+    memo = {}
+    level = [os.path.abspath(file)]
+    with ThreadPoolExecutor() as executor:
+        while level:
+            for path, lines in zip(level, executor.map(_read_lines, level)):
+                memo[path] = lines
+            next_level = []
+            for path in level:
+                for line in memo[path]:
+                    match = INCLUDE.match(line)
+                    if match:
+                        include = _include_path(match.group(1), path)
+                        if include is not None and include not in memo and include not in next_level:
+                            next_level.append(include)
+            level = next_level
+    return memo
+
+
+def _new_unit(state, source):
+    """
+    Start a new unit of lines to be read by read_itp, unless the current one has nothing in it yet.
+    """
+    unit = state['units'][-1] if state['units'] else None
+    if unit is not None and not unit['content'] and not unit['sections']:
+        unit['source'] = source
+        unit['lines'] = []
+    else:
+        state['units'].append({'source': source, 'lines': [], 'sections': set(), 'content': False})
+
+
+def _preprocess(path, memo, defines, state):
+    """
+    Evaluate the conditionals in a file and follow its #includes, as the gromacs preprocessor would
+
+    Lines are added to the units in state. Each unit holds at most one molecule, and starts at either
+    a [ moleculetype ] directive, an #include of a file with a molecule in it, or an #include found
+    outside of a molecule, so that the header of a molecule's itp stays with it.
+    #define statements are recorded in state rather than written to a unit.
+
+    Parameters
+    ----------
+    path: str
+        absolute path of the file to preprocess
+    memo: dict
+        absolute path: lines for each file in the include graph, as per _read_include_graph
+    defines: dict
+        name: parameters of the symbols defined so far
+    state: dict
+        the units, sections and defines found so far
+
+    Returns
+    -------
+    None
+    """
+    state['include_stack'].append(path)
+    conditionals = []
+    for line_number, line in enumerate(memo[path], start=1):
+        tokens = line.split(';')[0].split()
+
+        # evaluate the conditionals
+        if tokens and tokens[0] in ('#ifdef', '#ifndef'):
+            conditionals.append((tokens[1] in defines) == (tokens[0] == '#ifdef'))
+            continue
+        if tokens and tokens[0] in ('#else', '#endif'):
+            if not conditionals:
+                raise IOError(f"Your #ifdef/#ifndef section is ordered incorrectly. "
+                              f"Found {tokens[0]} at line {line_number} of {path}.")
+            if tokens[0] == '#else':
+                conditionals[-1] = not conditionals[-1]
+            else:
+                conditionals.pop()
+            continue
+        if not all(conditionals):
+            continue
+
+        if tokens and tokens[0] == '#define':
+            defines[tokens[1]] = tokens[2:5]
+            state['defines'][tokens[1]] = tokens[2:5]
+            continue
+        if tokens and tokens[0] == '#undef':
+            defines.pop(tokens[1], None)
+            continue
+
+        include = INCLUDE.match(line)
+        if include:
+            include_path = _include_path(include.group(1), path)
+            if include_path is None:
+                raise FileNotFoundError(f"Can't find {include.group(1)}, "
+                                        f"included at line {line_number} of {path}")
+            if include_path in state['include_stack']:
+                raise IOError(f"{include_path} includes itself, from line {line_number} of {path}")
+            if include_path not in memo:
+                memo[include_path] = _read_lines(include_path)
+            # an include within a molecule (e.g. position restraints) is part of that molecule,
+            # unless it starts a new molecule itself.
+            in_molecule = state['section'] not in FF_SECTIONS | {None, 'system', 'molecules'}
+            new_molecule = any(SECTION.match(i) and SECTION.match(i).group(1).lower() == 'moleculetype'
+                               for i in memo[include_path])
+            if new_molecule or not in_molecule:
+                _new_unit(state, include_path)
+            _preprocess(include_path, memo, defines, state)
+            # the rest of this file is credited to it rather than the included file,
+            # unless it continues a molecule from the included file (e.g. its position restraints).
+            if state['section'] in FF_SECTIONS | {None, 'system', 'molecules'}:
+                _new_unit(state, path)
+            continue
+
+        section = SECTION.match(line)
+        if section:
+            state['section'] = section.group(1).lower()
+            if state['section'] in ('system', 'molecules'):
+                state['system'].append(line)
+                continue
+            unit = state['units'][-1]
+            # every molecule gets a unit of its own, and force field parameters following an
+            # include belong to the including file rather than the unit of the included one.
+            # anything else continues the molecule of the current unit, wherever it was included from.
+            new_molecule = state['section'] == 'moleculetype' and unit['sections']
+            new_parameters = state['section'] in FF_SECTIONS and unit['content'] and unit['source'] != path
+            if new_molecule or new_parameters:
+                _new_unit(state, path)
+                unit = state['units'][-1]
+            unit['lines'].append(line)
+            unit['sections'].add(state['section'])
+            continue
+
+        if state['section'] == 'system':
+            state['system'].append(line)
+        elif state['section'] == 'molecules':
+            if tokens:
+                state['molecules'].append({'name': tokens[0],
+                                           'n_mols': tokens[1]})
+        else:
+            unit = state['units'][-1]
+            unit['lines'].append(line)
+            if tokens:
+                unit['content'] = True
+                unit['sections'].add(state['section'])
+
+    if conditionals:
+        raise IOError(f"Your #ifdef/#ifndef section is ordered incorrectly. "
+                      f"There are {len(conditionals)} unclosed conditionals in {path}.")
+    state['include_stack'].pop()
+
+
+def input_topol_reader(file, defines=('FLEXIBLE',)):
+    """
+    Read a .top file and everything it includes, evaluating preprocessor statements
+
+    Every file in the include graph is read once. The lines of the files are split into units
+    which can each be read by read_itp, holding either a single molecule or force field parameters.
+
+    Parameters
+    ----------
+    file: str
+        the .top file to read
+    defines: iterable
+        symbols to define before reading, as with -D in the gromacs mdp define option.
+        FLEXIBLE is defined by default so that constraints are read as bonds.
+
+    Returns
+    -------
+    topol_lines: dict
+        'core_itps': the file each unit of molecule or force field lines was found in
+        'itp_lines': the lines of each unit, in the same order as 'core_itps'
+        'defines': dictionary of definition: parameters for #define statements found in the files
+        'system': lines from the [ system ] directive up to the [ molecules ] directive
+        'molecules': list of {'name', 'n_mols'} entries from the [ molecules ] directive
+        'go': the files which only contain nonbonded parameters, e.g. those of a Gō model, if there are any
+    """
+    memo = _read_include_graph(file)
+    state = {'units': [],
+             'section': None,
+             'system': [],
+             'molecules': [],
+             'defines': {},
+             'include_stack': []}
+    _new_unit(state, os.path.abspath(file))
+    _preprocess(os.path.abspath(file), memo, {i: [] for i in defines}, state)
 
-def input_topol_reader(file):
     inclusions = []
-    molecules = []
-    system = []
+    itp_lines = []
     go = []
-    # read the topology file, find the header lines which are not core martini itps
-    with open(file) as f:
-        mols = False
-        sys = False
-        for line in f.readlines():
-            if '#include' in line:
-                if 'go' not in line:
-                    inclusions.append(line.split('"')[1])
-                else:
-                    go.append(line.split('"')[1])
-            if mols:
-                if len(line.split()) > 0:
-                    molecules.append({'name': line.split()[0],
-                                      'n_mols': line.split()[1]})
-            if 'molecules' in line:
-                mols = True
-                sys = False
-                system.append(line)
-            if 'system' in line:
-                sys = True
-            if sys:
-                system.append(line)
+    for unit in state['units']:
+        if not unit['content']:
+            continue
+        if unit['sections'] and unit['sections'] <= FF_SECTIONS - {'defaults'}:
+            if unit['source'] not in go:
+                go.append(unit['source'])
+        else:
+            inclusions.append(unit['source'])
+            itp_lines.append(unit['lines'])
+
     topol_lines = {'core_itps': inclusions,
-                   'system': system,
-                   'molecules': molecules}
+                   'itp_lines': itp_lines,
+                   'defines': state['defines'],
+                   'system': state['system'],
+                   'molecules': state['molecules']}
 
     if len(go) > 0:
         topol_lines['go'] = go
@@ -51,7 +269,7 @@ def input_topol_reader(file):
     return topol_lines
 
 
-def topol_writing(topol_lines, written_mols, ext='vis', w_include=None):
+def topol_writing(topol_lines, written_mols, ext='vis', w_include=None, every=1):
     """
 
     Write new .top file based on the input one
@@ -65,6 +283,9 @@ def topol_writing(topol_lines, written_mols, ext='vis', w_include=None):
     w_include
         if W_include is not None (ie. args.system has been given something)
         then the line for water is not written out in the .top file
+    every: int
+        only use the {molname}_{ext} topology for every Nth copy of a molecule, and the
+        {molname}_{ext}_nobonds topology for the rest, where that has been written
 
     Returns
     -------
@@ -89,12 +310,185 @@ def topol_writing(topol_lines, written_mols, ext='vis', w_include=None):
         except ValueError:
             print('No water to remove!')
             pass
+    nobonds_mols = [i.split(f'_{ext}_nobonds')[0] for i in written_mols if i.endswith(f'_{ext}_nobonds.itp')]
+    # copies of each molecule written so far, so that every Nth copy counts across [ molecules ] lines
+    copies = {}
     for i in topol_lines['molecules']:
         if any(mol in i['name'] for mol in original_mols):
-            topol_rest_vis.append(i['name'] + f'_{ext}\t' + i['n_mols'] + '\n')
+            if every > 1 and i['name'] in nobonds_mols:
+                # interleave the copies with bonds and those without
+                copy = copies.get(i['name'], 0)
+                end = copy + int(i['n_mols'])
+                copies[i['name']] = end
+                while copy < end:
+                    if copy % every == 0:
+                        topol_rest_vis.append(i['name'] + f'_{ext}\t1\n')
+                        copy += 1
+                    else:
+                        rest = min(end, (copy // every + 1) * every) - copy
+                        topol_rest_vis.append(i['name'] + f'_{ext}_nobonds\t{rest}\n')
+                        copy += rest
+            else:
+                topol_rest_vis.append(i['name'] + f'_{ext}\t' + i['n_mols'] + '\n')
     # combine the sections of the vis.top and write it out.
     vis_topol = new_topol_head + topol_lines['system'] + topol_rest_vis
 
     with open(f'{ext}.top', 'w') as f:
         f.writelines(vis_topol)
 
+
+def molecule_atom_count(ff, topol_lines, molname):
+    """
+    Find the number of atoms in a molecule
+
+    This comes from the molecule's block if it could be read, or otherwise from
+    the [ atoms ] directive of its preprocessed lines.
+
+    Parameters
+    ----------
+    ff: vermouth forcefield
+        force field containing the blocks of the molecules in the system
+    topol_lines: dict
+        lines from the input topology file split up into different keys, as per input_topol_reader
+    molname: str
+        name of the molecule
+
+    Returns
+    -------
+    n_atoms: int or None
+        number of atoms in the molecule, or None if it can't be found in the topology
+    """
+    if molname in ff.blocks:
+        return len(ff.blocks[molname])
+    # each unit of lines has at most one molecule in it
+    for lines in topol_lines['itp_lines']:
+        section = None
+        name = None
+        n_atoms = 0
+        for line in lines:
+            match = SECTION.match(line)
+            if match:
+                section = match.group(1).lower()
+                continue
+            tokens = line.split(';')[0].split()
+            if not tokens:
+                continue
+            if section == 'moleculetype' and name is None:
+                name = tokens[0]
+            elif section == 'atoms':
+                n_atoms += 1
+        if name == molname:
+            return n_atoms
+    return None
+
+
+def shard_writing(topol_lines, written_mols, ff, shard_by='moltype', ext='vis', w_include=None):
+    """
+    Write the system as a set of shards, each with its own .top file, index group and atom offsets
+
+    This allows a subset of the system to be loaded without processing the whole thing.
+    The shards are found in a single pass over the [ molecules ] directive of the input topology.
+
+    Parameters
+    ----------
+    topol_lines: dict
+        lines from the input topology file split up into different keys, as per input_topol_reader
+    written_mols: list
+        the visualisation itp files written for the molecules in the system
+    ff: vermouth forcefield
+        force field containing the blocks of all the molecules in the system
+    shard_by: str
+        'moltype': one shard for each molecule type
+        'molecules': one shard for each line of the [ molecules ] directive
+        'protein-copy': one shard for each copy of a molecule with backbone beads (i.e. each protein
+        moleculetype copy, so a protein with merged chains is a single shard), and one for each type
+        of the rest of the molecules
+    ext: str
+        the extension of the itp files to write shards of
+    w_include
+        if w_include is not None (ie. args.system has been given something)
+        then water is not written out in any shard
+
+    Returns
+    -------
+    shards: dict
+        shard name: the .top file, [ molecules ] lines and atom ranges of each shard
+    """
+    if shard_by not in ('moltype', 'molecules', 'protein-copy'):
+        raise ValueError(f"Can't shard by {shard_by}. Choose from moltype, molecules or protein-copy")
+
+    available = {os.path.basename(i)[:-len(f'_{ext}.itp')]: os.path.abspath(i)
+                 for i in written_mols if i.endswith(f'_{ext}.itp')}
+
+    shards = {}
+    offset = 0
+    protein_copies = {}
+    for index, mol in enumerate(topol_lines['molecules']):
+        molname = mol['name']
+        n_mols = int(mol['n_mols'])
+        n_atoms = molecule_atom_count(ff, topol_lines, molname)
+        if n_atoms is None:
+            raise ValueError(f"Can't find the atoms of {molname} in the input topology, "
+                             "so the atom offsets of the shards can't be worked out.")
+        if molname not in ff.blocks:
+            print(f"{molname} couldn't be read, so will be left out of the {ext} shards.")
+
+        if molname in available and not (w_include is not None and molname == 'W'):
+            if shard_by == 'moltype':
+                members = [(molname, n_mols)]
+            elif shard_by == 'molecules':
+                members = [(f'{index + 1}_{molname}', n_mols)]
+            elif any(ff.blocks[molname].nodes[node].get('atomname') == 'BB' for node in ff.blocks[molname].nodes):
+                start = protein_copies.get(molname, 0)
+                protein_copies[molname] = start + n_mols
+                members = [(f'{molname}_{start + copy + 1}', 1) for copy in range(n_mols)]
+            else:
+                members = [(molname, n_mols)]
+
+            shard_offset = offset
+            for shard_name, count in members:
+                shard = shards.setdefault(shard_name, {'top': f'{ext}_shard_{shard_name}.top',
+                                                       'includes': [],
+                                                       'molecules': [],
+                                                       'atom_ranges': []})
+                if available[molname] not in shard['includes']:
+                    shard['includes'].append(available[molname])
+                shard['molecules'].append(f'{molname}_{ext}\t{count}\n')
+                # atom ranges are 1-based and inclusive, as in the index file
+                first, last = shard_offset + 1, shard_offset + count * n_atoms
+                if shard['atom_ranges'] and shard['atom_ranges'][-1][1] == first - 1:
+                    shard['atom_ranges'][-1][1] = last
+                else:
+                    shard['atom_ranges'].append([first, last])
+                shard_offset = last
+
+        offset += n_mols * n_atoms
+
+    for shard in shards.values():
+        with open(shard['top'], 'w') as f:
+            f.writelines([f'#include "{i}"\n' for i in shard['includes']] +
+                         topol_lines['system'] + shard['molecules'])
+
+    # write an index group for each shard, split every 12th index as gromacs requires
+    with open(f'{ext}_shards.ndx', 'w') as fout:
+        for shard_name, shard in shards.items():
+            fout.write(f'[ {shard_name} ]\n')
+            line = []
+            for first, last in shard['atom_ranges']:
+                for atom in range(first, last + 1):
+                    line.append(atom)
+                    if len(line) == 12:
+                        fout.write(' '.join(map(str, line)) + ' \n')
+                        line = []
+            if line:
+                fout.write(' '.join(map(str, line)) + ' \n')
+
+    # write the offsets of each shard for other tools
+    with open(f'{ext}_shards.json', 'w') as fout:
+        json.dump({shard_name: {'top': os.path.abspath(shard['top']),
+                                'ndx_group': shard_name,
+                                'atom_ranges': shard['atom_ranges'],
+                                'n_atoms': sum(last - first + 1 for first, last in shard['atom_ranges'])}
+                   for shard_name, shard in shards.items()}, fout, indent=2)
+
+    return shards